@@ -13,134 +13,343 @@ Trade-off: 30-45 second cold start (model baked into image)
 """
 
 import os
+import json
+import time
 import logging
+import threading
+import functools
+from collections import OrderedDict
 from dotenv import load_dotenv
 
 # Load .env file (for local development)
 load_dotenv()
 
-from flask import Flask, request, jsonify
+# CPU threading must be configured before torch (imported by transformers) loads.
+# TORCH_NUM_THREADS wins, then the standard OMP_NUM_THREADS; with neither set, torch's own
+# default (physical cores, not SMT siblings) is kept. On Cloud Run set one of them to the
+# instance's vCPU count (2) so OpenMP doesn't size its pool from the host.
+NUM_THREADS = os.environ.get('TORCH_NUM_THREADS') or os.environ.get('OMP_NUM_THREADS')
+if NUM_THREADS:
+    NUM_THREADS = int(NUM_THREADS)
+    os.environ.setdefault('OMP_NUM_THREADS', str(NUM_THREADS))
+    os.environ.setdefault('MKL_NUM_THREADS', str(NUM_THREADS))
+os.environ.setdefault('MKL_DYNAMIC', 'FALSE')
+
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from huggingface_hub import login
 import torch
 
+from decoding import fast_decode, fast_decode_supported, inference_context, sampling_kwargs, stream_events
+
+# Single-request decode gets nothing from inter-op parallelism; keep all threads intra-op
+NUM_THREADS = NUM_THREADS or torch.get_num_threads()
+torch.set_num_threads(NUM_THREADS)
+torch.set_num_interop_threads(1)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-# Enable CORS for all routes
-CORS(app, resources={r"/*": {"origins": "*"}})
+# Enable CORS for all routes (max_age lets browsers cache the preflight for a day)
+CORS(app, resources={r"/*": {"origins": "*"}}, max_age=86400)
 
 # Model configuration
 MODEL_NAME = "PleIAs/Pleias-350m-Preview"
 # Use baked-in model cache if available, otherwise use default HF cache
 MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', None)
+# Safetensors snapshot written by download_model.py (preferred over the hub cache layout)
+BAKED_MODEL_DIR = os.path.join(MODEL_CACHE_DIR, 'final') if MODEL_CACHE_DIR else None
+# HuggingFace token (needed for private/gated models)
+HF_TOKEN = os.environ.get('HF_TOKEN') or os.environ.get('HUGGINGFACE_HUB_TOKEN')
 # Set to "true" to load model at startup in a background thread (useful with min-instances=1)
 EAGER_LOAD = os.environ.get('EAGER_LOAD', 'false').lower() == 'true'
+# Set to "1" to load the model synchronously at import. gunicorn.conf.py then enables
+# preload_app so workers fork from a master that already holds the weights.
+PRELOAD = os.environ.get('PRELOAD', '0') == '1'
+# Weight dtype for CPU inference. bfloat16 halves the bytes streamed per token vs float32
+# and uses the native BF16 matmul kernels on AVX-512/AMX CPUs. Set to "float32" on older CPUs.
+DTYPE = os.environ.get('TORCH_DTYPE', 'bfloat16').lower()
+TORCH_DTYPES = {
+    'bfloat16': torch.bfloat16,
+    'float16': torch.float16,
+    'float32': torch.float32,
+}
+# Set to "int8" to dynamically quantize Linear layers (weights are loaded as float32 first)
+QUANTIZE = os.environ.get('QUANTIZE', '').lower()
+# Set to "1" to optimize the model with intel-extension-for-pytorch (bf16 weight prepacking,
+# op fusion). Ignored with QUANTIZE=int8, whose quantized Linear layers IPEX can't prepack.
+USE_IPEX = os.environ.get('USE_IPEX', '0') == '1' and QUANTIZE != 'int8'
+# Set to "false" to always decode through transformers' generate() instead of fast_decode
+FAST_DECODE = os.environ.get('FAST_DECODE', 'true').lower() == 'true'
+# How many generations may run on the model at once. Each one uses NUM_THREADS OpenMP
+# threads, so gunicorn's extra request threads only parse, tokenize and answer probes.
+GENERATE_CONCURRENCY = int(os.environ.get('GENERATE_CONCURRENCY', 1))
+
+# Authenticate once per process rather than on every model load.
+# from_pretrained also receives token=HF_TOKEN, so a failed login is not fatal.
+if HF_TOKEN:
+    try:
+        logger.info("Authenticating with HuggingFace...")
+        login(token=HF_TOKEN, add_to_git_credential=False)
+    except Exception as e:
+        logger.warning(f"HuggingFace login failed, relying on token= in from_pretrained: {e}")
+
+SYSTEM_PROMPT = 'You are an ethical AI writing assistant trained on legally licensed materials.'
+# Per-role message formats for the chat prompt; other roles use _DEFAULT_MESSAGE_TEMPLATE
+_MESSAGE_TEMPLATES = {'user': '[INST] {} [/INST]'}
+_DEFAULT_MESSAGE_TEMPLATE = ' {} '
+# Chat prompts are truncated to this many tokens to leave room for generation
+CHAT_MAX_INPUT_TOKENS = 400
+# Prompts longer than this (in characters) are rejected before tokenization
+MAX_PROMPT_CHARS = 16384
+# /chat keeps the KV cache of recent sessions (X-Session-Id header) so follow-up turns
+# only run the model over tokens it hasn't seen. Each entry holds a few tens of MB.
+KV_CACHE_TTL = int(os.environ.get('KV_CACHE_TTL', 600))  # seconds
+KV_CACHE_MAX_SESSIONS = int(os.environ.get('KV_CACHE_MAX_SESSIONS', 8))
 
 model = None
 tokenizer = None
 model_loading = False  # Track if model is currently loading
+ipex_applied = False  # True once ipex.optimize has actually run on the loaded model
+_model_lock = threading.Lock()  # Guards model_loading so only one thread loads
+_model_ready = threading.Event()  # Set when a load attempt finishes (success or failure)
+_kv_sessions = OrderedDict()  # session id -> (last used, token ids, past_key_values), LRU order
+_kv_lock = threading.Lock()
+_generate_slots = threading.Semaphore(GENERATE_CONCURRENCY)  # Bounds concurrent model execution
+
+def _claim_model_load():
+    """Mark the model as loading. Returns False if it is already loaded or loading."""
+    global model_loading
+    with _model_lock:
+        if model is not None or model_loading:
+            return False
+        model_loading = True
+        _model_ready.clear()
+        return True
+
+class ModelNotLoadedError(RuntimeError):
+    """The model is needed but the load attempt failed; handlers answer 503"""
 
 def get_model():
     """Lazy load the model on first request"""
-    global model, tokenizer, model_loading
     if model is None:
-        if model_loading:
-            # Wait for background load to complete
-            import time
-            while model_loading and model is None:
-                time.sleep(0.5)
+        if _claim_model_load():
+            try:
+                load_model()
+            except Exception as e:
+                raise ModelNotLoadedError(f"Model failed to load: {e}") from e
         else:
-            load_model()
+            # Another request or the EAGER_LOAD thread is loading - wait for it
+            _model_ready.wait()
+            if model is None:
+                # That attempt failed; the next request claims a fresh load
+                raise ModelNotLoadedError("Model failed to load, retry shortly")
     return model, tokenizer
 
+@functools.lru_cache(maxsize=64)
+def _tokenize_cached(text, add_special_tokens=False):
+    """Token ids for a prompt segment that repeats across requests (system prompt, manuscript context)"""
+    return tuple(tokenizer(text, add_special_tokens=add_special_tokens).input_ids)
+
+def _take_session_cache(session_id, ids):
+    """Remove and return the session's KV cache cropped to the prefix it shares with ids, or None"""
+    with _kv_lock:
+        now = time.monotonic()
+        for sid in [sid for sid, (used, _, _) in _kv_sessions.items() if now - used > KV_CACHE_TTL]:
+            del _kv_sessions[sid]
+        entry = _kv_sessions.pop(session_id, None)
+    if entry is None:
+        return None
+    
+    _, cached_ids, past_key_values = entry
+    # Leave at least one prompt token uncached so generate() has something to feed the model
+    limit = min(past_key_values.get_seq_length(), len(ids) - 1)
+    shared = 0
+    while shared < limit and cached_ids[shared] == ids[shared]:
+        shared += 1
+    if shared == 0:
+        return None
+    past_key_values.crop(shared)
+    return past_key_values
+
+def _store_session_cache(session_id, token_ids, past_key_values):
+    """Keep a session's KV cache for its next turn, evicting the least recently used"""
+    with _kv_lock:
+        _kv_sessions[session_id] = (time.monotonic(), token_ids, past_key_values)
+        _kv_sessions.move_to_end(session_id)
+        while len(_kv_sessions) > KV_CACHE_MAX_SESSIONS:
+            _kv_sessions.popitem(last=False)
+
+def run_generate(current_model, generate_kwargs):
+    """Decode with fast_decode when it matches generate() for this model, else generate().
+    Returns (sequences, past_key_values). Call inside inference_context(ipex_applied)."""
+    with _generate_slots:
+        if FAST_DECODE and fast_decode_supported(current_model, generate_kwargs):
+            return fast_decode(
+                current_model,
+                generate_kwargs['input_ids'],
+                generate_kwargs.get('attention_mask'),
+                generate_kwargs['max_new_tokens'],
+                generate_kwargs.get('temperature', 0) if generate_kwargs.get('do_sample') else 0,
+                past_key_values=generate_kwargs.get('past_key_values')
+            )
+        outputs = current_model.generate(**generate_kwargs, return_dict_in_generate=True)
+        return outputs.sequences, outputs.past_key_values
+
+def _baked_snapshot_available():
+    """True if download_model.py left a safetensors snapshot in the image"""
+    return BAKED_MODEL_DIR is not None and os.path.isdir(BAKED_MODEL_DIR)
+
+def _baked_snapshot_dtype():
+    """dtype name download_model.py saved the snapshot in, or None if its config doesn't say"""
+    try:
+        with open(os.path.join(BAKED_MODEL_DIR, 'config.json')) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return config.get('torch_dtype') or config.get('dtype')
+
+def warm_page_cache():
+    """Read baked weight files once so the later mmap load is served from RAM, not disk"""
+    if not _baked_snapshot_available():
+        return
+    for name in os.listdir(BAKED_MODEL_DIR):
+        if name.endswith('.safetensors'):
+            with open(os.path.join(BAKED_MODEL_DIR, name), 'rb') as f:
+                while f.read(16 * 1024 * 1024):
+                    pass
+    logger.info("Model weights prefetched into page cache")
+
 def load_model():
     """Load the model and tokenizer"""
-    global model, tokenizer
-    logger.info(f"Loading model: {MODEL_NAME}")
+    global model, tokenizer, model_loading, ipex_applied
+    use_snapshot = _baked_snapshot_available()
+    model_path = BAKED_MODEL_DIR if use_snapshot else MODEL_NAME
+    # quantize_dynamic expects float32 Linear weights, so ignore TORCH_DTYPE when quantizing
+    load_dtype = torch.float32 if QUANTIZE == 'int8' else TORCH_DTYPES.get(DTYPE, torch.bfloat16)
+    logger.info(f"Loading model: {MODEL_NAME} ({load_dtype})")
     if MODEL_CACHE_DIR:
-        logger.info(f"Using baked-in cache: {MODEL_CACHE_DIR}")
+        logger.info(f"Using baked-in cache: {BAKED_MODEL_DIR if use_snapshot else MODEL_CACHE_DIR}")
+    if use_snapshot:
+        snapshot_dtype = _baked_snapshot_dtype()
+        if snapshot_dtype and f'torch.{snapshot_dtype}' != str(load_dtype):
+            # Upcasting can't restore precision the snapshot already rounded away
+            logger.warning(
+                f"Baked snapshot is {snapshot_dtype} but {load_dtype} was requested; weights are "
+                f"converted at load. Rebuild the image with matching TORCH_DTYPE/QUANTIZE build args."
+            )
     
     try:
-        # Login to HuggingFace if token is available (needed for private/gated models)
-        hf_token = os.environ.get('HF_TOKEN') or os.environ.get('HUGGINGFACE_HUB_TOKEN')
-        if hf_token:
-            logger.info("Authenticating with HuggingFace...")
-            login(token=hf_token)
-        
         # Load tokenizer (from cache if baked in, otherwise downloads)
         tokenizer = AutoTokenizer.from_pretrained(
-            MODEL_NAME, 
-            token=hf_token,
+            model_path, 
+            token=HF_TOKEN,
             cache_dir=MODEL_CACHE_DIR,
             local_files_only=MODEL_CACHE_DIR is not None  # Don't download if using baked cache
         )
         
         # Load model (CPU-only for cost efficiency)
-        model = AutoModelForCausalLM.from_pretrained(
-            MODEL_NAME,
-            torch_dtype=torch.float32,
+        loaded_model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            # The snapshot is safetensors, so weights are mmap'd rather than unpickled
+            use_safetensors=True if use_snapshot else None,
+            torch_dtype=load_dtype,
             low_cpu_mem_usage=True,
-            token=hf_token,
+            token=HF_TOKEN,
             cache_dir=MODEL_CACHE_DIR,
             local_files_only=MODEL_CACHE_DIR is not None
         )
+        loaded_model.eval()  # Inference only - disable dropout
+        
+        if QUANTIZE == 'int8':
+            # Embeddings and LayerNorm are left in float32
+            logger.info("Quantizing Linear layers to int8...")
+            loaded_model = torch.ao.quantization.quantize_dynamic(loaded_model, {torch.nn.Linear}, dtype=torch.qint8)
+        
+        if USE_IPEX:
+            try:
+                import intel_extension_for_pytorch as ipex  # Optional x86-only dependency
+            except ImportError:
+                logger.warning("USE_IPEX=1 but intel_extension_for_pytorch is not installed - continuing without it")
+            else:
+                logger.info("Optimizing model with IPEX (bfloat16)...")
+                loaded_model = ipex.optimize(loaded_model, dtype=torch.bfloat16, inplace=True)
+                ipex_applied = True
+        
+        # Publish only once fully prepared so other threads never see a half-built model
+        model = loaded_model
         logger.info("Model loaded successfully")
     except Exception as e:
         logger.error(f"Error loading model: {str(e)}")
-        model_loading = False
         raise
     finally:
         model_loading = False
+        # Wake waiters even on failure; get_model raises ModelNotLoadedError for them
+        # and leaves the retry to the next request
+        _model_ready.set()
 
 def load_model_background():
     """Load model in background thread"""
-    global model_loading
-    model_loading = True
+    if not _claim_model_load():
+        return
     try:
         load_model()
     except Exception as e:
         logger.error(f"Background model load failed: {e}")
 
+# Load model at import if PRELOAD is set; forked workers share the weight pages copy-on-write
+if PRELOAD:
+    logger.info("PRELOAD enabled - loading model before workers fork...")
+    if _claim_model_load():
+        load_model()
 # Load model at startup in background thread if EAGER_LOAD is enabled
-if EAGER_LOAD:
-    import threading
+elif EAGER_LOAD:
     logger.info("EAGER_LOAD enabled - starting background model load...")
     threading.Thread(target=load_model_background, daemon=True).start()
+else:
+    # Lazy loading - still pull the baked weights into the page cache while idle
+    threading.Thread(target=warm_page_cache, daemon=True).start()
+
+def _json_body(payload):
+    """Serialize a response body that never changes at runtime"""
+    return json.dumps(payload).encode()
+
+# /health is probed constantly, so its two possible bodies are serialized once up front
+_HEALTH_LOADED = _json_body({'status': 'healthy', 'model': MODEL_NAME, 'model_loaded': True})
+_HEALTH_NOT_LOADED = _json_body({'status': 'healthy', 'model': MODEL_NAME, 'model_loaded': False})
+_DEBUG_ENV = _json_body({
+    'hf_token_configured': HF_TOKEN is not None,
+    'hf_token_masked': f"{HF_TOKEN[:4]}...{HF_TOKEN[-4:]}" if HF_TOKEN else "NOT SET",
+    'port': os.environ.get('PORT', 'not set')
+})
+_ROOT_INFO = _json_body({
+    'name': 'PleIAs API',
+    'model': MODEL_NAME,
+    'endpoints': {
+        'health': '/health',
+        'debug': '/debug/env',
+        'generate': '/generate (POST)',
+        'chat': '/chat (POST)'
+    }
+})
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint - returns healthy even if model not loaded yet"""
-    return jsonify({
-        'status': 'healthy',
-        'model': MODEL_NAME,
-        'model_loaded': model is not None
-    })
+    return Response(_HEALTH_LOADED if model is not None else _HEALTH_NOT_LOADED, mimetype='application/json')
 
 @app.route('/debug/env', methods=['GET'])
 def debug_env():
     """Debug endpoint to check if HF token is configured (shows only first/last 4 chars)"""
-    hf_token = os.environ.get('HF_TOKEN') or os.environ.get('HUGGINGFACE_HUB_TOKEN')
-    if hf_token:
-        masked = f"{hf_token[:4]}...{hf_token[-4:]}"
-    else:
-        masked = "NOT SET"
-    return jsonify({
-        'hf_token_configured': hf_token is not None,
-        'hf_token_masked': masked,
-        'port': os.environ.get('PORT', 'not set')
-    })
+    return Response(_DEBUG_ENV, mimetype='application/json')
 
 @app.route('/generate', methods=['POST'])
 def generate_text():
     """Generate text from a prompt"""
     try:
-        # Lazy load model on first request
-        current_model, current_tokenizer = get_model()
-        
         # Get request data
         data = request.get_json()
         if not data or 'prompt' not in data:
@@ -149,15 +358,25 @@ def generate_text():
             }), 400
 
         prompt = data['prompt']
-        max_length = data.get('max_length', 100)
+        # Cheap length check before spending a tokenizer pass (or a model load) on it
+        if len(prompt) > MAX_PROMPT_CHARS:
+            return jsonify({
+                'error': f'prompt cannot exceed {MAX_PROMPT_CHARS} characters'
+            }), 413
+        
+        # max_length is accepted for older clients but treated as a new-token budget
+        max_new_tokens = data.get('max_new_tokens', data.get('max_length', 100))
         temperature = data.get('temperature', 0.7)
 
         # Validate parameters
-        if max_length > 500:
+        if max_new_tokens > 500:
             return jsonify({
-                'error': 'max_length cannot exceed 500 tokens'
+                'error': 'max_new_tokens cannot exceed 500 tokens'
             }), 400
 
+        # Lazy load model on first request
+        current_model, current_tokenizer = get_model()
+
         logger.info(f"Generating text for prompt: {prompt[:50]}...")
 
         # Tokenize input
@@ -165,19 +384,39 @@ def generate_text():
         
         # Ensure input_ids are Long type (fixes scalarType errors)
         input_ids = inputs.input_ids.long()
+        attention_mask = inputs.attention_mask.long() if inputs.attention_mask is not None else None
+        
+        # Keep prompt + new tokens within the model's context window. This is a continuation
+        # endpoint, so drop the *start* of an over-long prompt and continue from its end.
+        max_positions = getattr(current_model.config, 'max_position_embeddings', 2048)
+        input_limit = max_positions - max_new_tokens
+        truncated = input_ids.shape[1] > input_limit
+        if truncated:
+            input_ids = input_ids[:, -input_limit:]
+            attention_mask = attention_mask[:, -input_limit:] if attention_mask is not None else None
 
-        # Generate
-        with torch.no_grad():
-            outputs = current_model.generate(
-                input_ids,
-                max_length=max_length,
-                temperature=temperature,
-                do_sample=True,
-                pad_token_id=current_tokenizer.eos_token_id
-            )
+        # Generate using max_new_tokens so long prompts still produce output
+        generate_kwargs = dict(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=max_new_tokens,
+            use_cache=True,
+            pad_token_id=current_tokenizer.eos_token_id,
+            **sampling_kwargs(temperature)
+        )
+        if data.get('stream'):
+            events = stream_events(current_model, current_tokenizer, generate_kwargs, _generate_slots, ipex_applied)
+            return Response(stream_with_context(events), mimetype='text/event-stream')
+        
+        with inference_context(ipex_applied):
+            sequences, _ = run_generate(current_model, generate_kwargs)
 
-        # Decode output
-        generated_text = current_tokenizer.decode(outputs[0], skip_special_tokens=True)
+        # Decode output; a truncated prompt is echoed in full ahead of the continuation
+        if truncated:
+            continuation = current_tokenizer.decode(sequences[0, input_ids.shape[1]:], skip_special_tokens=True)
+            generated_text = prompt + continuation
+        else:
+            generated_text = current_tokenizer.decode(sequences[0], skip_special_tokens=True)
 
         # Return response
         return jsonify({
@@ -186,6 +425,12 @@ def generate_text():
             'model': MODEL_NAME
         })
 
+    except ModelNotLoadedError as e:
+        logger.error(str(e))
+        return jsonify({
+            'error': 'Model not loaded',
+            'details': str(e)
+        }), 503
     except Exception as e:
         logger.error(f"Error generating text: {str(e)}")
         return jsonify({
@@ -200,62 +445,85 @@ def chat():
         return '', 204
     
     try:
-        current_model, current_tokenizer = get_model()
-        
         data = request.get_json()
         messages = data.get('messages', [])
         manuscript_context = data.get('manuscriptContext', '')
+        temperature = data.get('temperature', 0.7)
+        
+        # Manuscript context is capped below, so only the messages count toward the limit
+        if sum(len(m.get('content', '')) for m in messages) > MAX_PROMPT_CHARS:
+            return jsonify({
+                'error': f'messages cannot exceed {MAX_PROMPT_CHARS} characters'
+            }), 413
+        
+        current_model, current_tokenizer = get_model()
         
-        # Build system prompt
-        system_prompt = 'You are an ethical AI writing assistant trained on legally licensed materials.'
-        if manuscript_context:
-            system_prompt += f'\n\nManuscript context:\n{manuscript_context[:2000]}'
+        # Manuscript context follows the system prompt
+        context_prompt = f'\n\nManuscript context:\n{manuscript_context[:2000]}' if manuscript_context else ''
         
         # Convert messages to prompt format
-        message_prompt = '\n'.join([
-            f"{'[INST]' if m.get('role') == 'user' else ''} {m.get('content', '')} {'[/INST]' if m.get('role') == 'user' else ''}"
+        message_prompt = '\n'.join(
+            _MESSAGE_TEMPLATES.get(m.get('role'), _DEFAULT_MESSAGE_TEMPLATE).format(m.get('content', ''))
             for m in messages
-        ])
-        
-        full_prompt = f"{system_prompt}\n\n{message_prompt}"
+        )
         
-        logger.info(f"Chat request, prompt length: {len(full_prompt)}")
+        # Tokenize the reusable prefix from cache and only the message turns fresh,
+        # truncating to avoid exceeding model limits
+        ids = (
+            _tokenize_cached('', add_special_tokens=True)  # BOS, if the tokenizer uses one
+            + _tokenize_cached(SYSTEM_PROMPT)
+            + _tokenize_cached(context_prompt)
+            + tuple(current_tokenizer(f"\n\n{message_prompt}", add_special_tokens=False).input_ids)
+        )[:CHAT_MAX_INPUT_TOKENS]
         
-        # Tokenize input with truncation to avoid exceeding model limits
-        inputs = current_tokenizer(
-            full_prompt, 
-            return_tensors="pt",
-            truncation=True,
-            max_length=400  # Leave room for generation
-        )
+        logger.info(f"Chat request, prompt tokens: {len(ids)}")
         
-        # Ensure input_ids are Long type (fixes scalarType errors)
-        input_ids = inputs.input_ids.long()
-        attention_mask = inputs.attention_mask.long() if inputs.attention_mask is not None else None
+        # Build Long tensors directly (fixes scalarType errors)
+        input_ids = torch.tensor([ids], dtype=torch.long)
+        attention_mask = torch.ones_like(input_ids)
         
         # Generate using max_new_tokens (not max_length) to avoid input > output length errors
-        with torch.no_grad():
-            outputs = current_model.generate(
-                input_ids,
-                attention_mask=attention_mask,
-                max_new_tokens=200,
-                temperature=0.7,
-                do_sample=True,
-                pad_token_id=current_tokenizer.eos_token_id
-            )
+        generate_kwargs = dict(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=200,
+            use_cache=True,
+            pad_token_id=current_tokenizer.eos_token_id,
+            **sampling_kwargs(temperature)
+        )
+        if data.get('stream'):
+            # Streamed chunks contain only new text, so no prompt stripping is needed
+            events = stream_events(current_model, current_tokenizer, generate_kwargs, _generate_slots, ipex_applied)
+            return Response(stream_with_context(events), mimetype='text/event-stream')
+        
+        session_id = request.headers.get('X-Session-Id')
+        with inference_context(ipex_applied):
+            if session_id:
+                # Reuse the previous turn's KV cache so only the new tokens are processed
+                past_key_values = _take_session_cache(session_id, ids)
+                if past_key_values is not None:
+                    generate_kwargs['past_key_values'] = past_key_values
+            sequences, past_key_values = run_generate(current_model, generate_kwargs)
         
-        # Decode output
-        generated_text = current_tokenizer.decode(outputs[0], skip_special_tokens=True)
+        # Older transformers return legacy tuple caches, which can't be cropped for reuse
+        if session_id and hasattr(past_key_values, 'crop'):
+            _store_session_cache(session_id, sequences[0].tolist(), past_key_values)
         
-        # Remove the prompt from the response if included
-        if generated_text.startswith(full_prompt):
-            generated_text = generated_text[len(full_prompt):].strip()
+        # Decode only the newly generated tokens (slicing in token space, not characters)
+        input_len = input_ids.shape[1]
+        generated_text = current_tokenizer.decode(sequences[0, input_len:], skip_special_tokens=True).strip()
         
         return jsonify({
             'text': generated_text,
             'model': MODEL_NAME
         })
     
+    except ModelNotLoadedError as e:
+        logger.error(str(e))
+        return jsonify({
+            'error': 'Model not loaded',
+            'details': str(e)
+        }), 503
     except Exception as e:
         logger.error(f"Error in chat: {str(e)}")
         return jsonify({
@@ -266,17 +534,9 @@ def chat():
 @app.route('/', methods=['GET'])
 def root():
     """Root endpoint with API information"""
-    return jsonify({
-        'name': 'PleIAs API',
-        'model': MODEL_NAME,
-        'endpoints': {
-            'health': '/health',
-            'debug': '/debug/env',
-            'generate': '/generate (POST)',
-            'chat': '/chat (POST)'
-        }
-    })
+    return Response(_ROOT_INFO, mimetype='application/json')
 
 if __name__ == '__main__':
+    # Local development only - production runs under gunicorn (see Dockerfile)
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,132 @@
+"""
+Generation helpers shared by the Docker (app.py) and VM (vm-setup/app.py) APIs.
+On a 350M model, generate()'s per-step logits-processor and stopping-criteria machinery is
+a real share of per-token time; fast_decode calls the model forward directly instead.
+stream_events covers streamed requests, which still go through generate().
+"""
+import json
+import logging
+import threading
+import contextlib
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+logger = logging.getLogger(__name__)
+
+# Generation-config fields (as reported by to_diff_dict) that fast_decode reproduces or that
+# don't affect decoding. Anything else - top_p, repetition_penalty, sequence_bias, stop_strings,
+# watermarking, fields added by future transformers versions - falls back to generate().
+FAST_DECODE_CONFIG_KEYS = {
+    'bos_token_id', 'eos_token_id', 'pad_token_id', 'decoder_start_token_id',
+    'do_sample', 'temperature', 'top_k', 'max_length', 'use_cache',
+    'transformers_version', '_from_model_config', '_commit_hash', '_original_object_hash',
+}
+# generate() kwargs that fast_decode understands
+FAST_DECODE_KWARGS = {
+    'input_ids', 'attention_mask', 'max_new_tokens', 'use_cache', 'pad_token_id',
+    'do_sample', 'temperature', 'num_beams', 'past_key_values',
+}
+
+@contextlib.contextmanager
+def inference_context(bf16_autocast=False):
+    """Context for running the model - inference_mode, plus bf16 autocast (set when IPEX optimized it)"""
+    autocast = torch.autocast('cpu', dtype=torch.bfloat16) if bf16_autocast else contextlib.nullcontext()
+    with torch.inference_mode(), autocast:
+        yield
+
+def sampling_kwargs(temperature):
+    """generate() decoding args - greedy when temperature is 0, which skips softmax + multinomial"""
+    if temperature > 0:
+        return {'do_sample': True, 'temperature': temperature, 'num_beams': 1}
+    return {'do_sample': False, 'num_beams': 1}
+
+def fast_decode_supported(current_model, generate_kwargs):
+    """True if fast_decode produces what generate() would for this model and these kwargs"""
+    if not set(generate_kwargs) <= FAST_DECODE_KWARGS or generate_kwargs.get('num_beams', 1) != 1:
+        return False
+    return set(current_model.generation_config.to_diff_dict()) <= FAST_DECODE_CONFIG_KEYS
+
+def fast_decode(current_model, input_ids, attention_mask, max_new_tokens, temperature, past_key_values=None):
+    """Sample (greedy when temperature is 0) by calling the model forward directly.
+
+    Applies the generation config's top_k the way generate() does. Returns
+    (sequences, past_key_values) with generate()'s semantics. Call inside inference_mode.
+    """
+    config = current_model.generation_config
+    eos_ids = config.eos_token_id if isinstance(config.eos_token_id, (list, tuple)) else [config.eos_token_id]
+    top_k = config.top_k or 0
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    
+    sequences = input_ids
+    # Only feed the tokens the cache hasn't seen yet
+    next_input = input_ids if past_key_values is None else input_ids[:, past_key_values.get_seq_length():]
+    for _ in range(max_new_tokens):
+        out = current_model(
+            input_ids=next_input,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True
+        )
+        past_key_values = out.past_key_values
+        logits = out.logits[:, -1, :].float()
+        if temperature > 0:
+            logits = logits / temperature
+            if 0 < top_k < logits.shape[-1]:
+                kth = torch.topk(logits, top_k).values[:, -1:]
+                logits = logits.masked_fill(logits < kth, float('-inf'))
+            next_token = torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1)
+        else:
+            next_token = logits.argmax(dim=-1, keepdim=True)
+        sequences = torch.cat([sequences, next_token], dim=-1)
+        if next_token.item() in eos_ids:
+            break
+        next_input = next_token
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((1, 1))], dim=-1)
+    return sequences, past_key_values
+
+class StopOnEvent(StoppingCriteria):
+    """Stops generate() once the given threading.Event is set"""
+    def __init__(self, event):
+        self.event = event
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool)
+
+def stream_events(current_model, current_tokenizer, generate_kwargs, generate_slots, bf16_autocast=False):
+    """Start generate() in a worker thread and return a generator of server-sent events with its new text.
+
+    generate_slots is the app's semaphore bounding concurrent model execution.
+    """
+    streamer = TextIteratorStreamer(current_tokenizer, skip_prompt=True, skip_special_tokens=True)
+    stop = threading.Event()  # Set when the client goes away so generation stops early
+    errors = []
+    
+    def run():
+        try:
+            with generate_slots, inference_context(bf16_autocast):
+                current_model.generate(
+                    **generate_kwargs,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([StopOnEvent(stop)])
+                )
+        except Exception as e:
+            logger.error(f"Error in streamed generation: {str(e)}")
+            errors.append(str(e))
+            streamer.end()  # Unblock the response iterator
+    
+    def events():
+        try:
+            for text in streamer:
+                if text:  # The streamer queues empty strings while a word is incomplete
+                    yield f"data: {json.dumps({'text': text})}\n\n"
+            if errors:
+                yield f"data: {json.dumps({'error': errors[0]})}\n\n"
+            yield "data: [DONE]\n\n"
+        finally:
+            # Runs on normal completion and on client disconnect (GeneratorExit)
+            stop.set()
+    
+    threading.Thread(target=run, daemon=True).start()
+    return events()
@@ -3,11 +3,24 @@ Pre-download model at Docker build time.
 This bakes the model into the image, eliminating download time on cold starts.
 """
 import os
+import shutil
+import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from huggingface_hub import login
 
 MODEL_NAME = "PleIAs/Pleias-350m-Preview"
 MODEL_CACHE_DIR = "/app/model_cache"
+# Self-contained safetensors snapshot that app.py loads via mmap
+FINAL_DIR = os.path.join(MODEL_CACHE_DIR, "final")
+# Save the snapshot in the dtype app.py loads with, so loading it needs no conversion copy.
+# QUANTIZE=int8 loads float32 weights, and a bf16 snapshot would lose precision before quantizing.
+QUANTIZE = os.environ.get('QUANTIZE', '').lower()
+SNAPSHOT_DTYPE = 'float32' if QUANTIZE == 'int8' else os.environ.get('TORCH_DTYPE', 'bfloat16').lower()
+TORCH_DTYPES = {
+    'bfloat16': torch.bfloat16,
+    'float16': torch.float16,
+    'float32': torch.float32,
+}
 
 def download_model():
     hf_token = os.environ.get('HF_TOKEN')
@@ -29,10 +42,23 @@ def download_model():
     model = AutoModelForCausalLM.from_pretrained(
         MODEL_NAME, 
         token=hf_token,
-        cache_dir=MODEL_CACHE_DIR
+        cache_dir=MODEL_CACHE_DIR,
+        torch_dtype=TORCH_DTYPES.get(SNAPSHOT_DTYPE, torch.bfloat16)
     )
     
     print(f"Model downloaded successfully to {MODEL_CACHE_DIR}")
+    
+    # Re-save as safetensors so the app can memory-map weights instead of unpickling .bin
+    print(f"Saving {SNAPSHOT_DTYPE} safetensors snapshot to {FINAL_DIR}...")
+    model.save_pretrained(FINAL_DIR, safe_serialization=True)
+    tokenizer.save_pretrained(FINAL_DIR)
+    
+    # app.py loads from FINAL_DIR only, so drop the hub cache copy (models--*, .locks)
+    # rather than carrying the weights in the image twice
+    for name in os.listdir(MODEL_CACHE_DIR):
+        path = os.path.join(MODEL_CACHE_DIR, name)
+        if name != "final" and os.path.isdir(path):
+            shutil.rmtree(path)
     print(f"Cache contents: {os.listdir(MODEL_CACHE_DIR)}")
 
 if __name__ == "__main__":
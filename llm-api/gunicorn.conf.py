@@ -0,0 +1,12 @@
+"""
+Gunicorn settings for the Docker/Cloud Run deployment.
+Gunicorn reads ./gunicorn.conf.py automatically; command-line flags in the Dockerfile
+CMD (bind, workers, threads) take precedence over anything set here.
+"""
+import os
+
+# With PRELOAD=1, app.py loads the model at import. Preloading the app imports it once
+# in the master, so workers fork with the weights already mapped and share those pages
+# copy-on-write (inference never writes to them). Only enabled together with PRELOAD:
+# EAGER_LOAD's background thread would not survive the fork.
+preload_app = os.environ.get('PRELOAD', '0') == '1'
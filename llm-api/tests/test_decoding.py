@@ -0,0 +1,77 @@
+"""Checks that decoding.fast_decode matches transformers' generate() on a tiny random model."""
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from decoding import fast_decode, fast_decode_supported  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def tiny_model():
+    torch.manual_seed(0)
+    # Llama-style like the served Pleias model, so the cache is a croppable DynamicCache
+    config = transformers.LlamaConfig(
+        vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=2, num_key_value_heads=2, max_position_embeddings=64,
+        bos_token_id=63, eos_token_id=63,
+    )
+    return transformers.LlamaForCausalLM(config).eval()
+
+
+def test_greedy_matches_generate(tiny_model):
+    input_ids = torch.tensor([[1, 2, 3, 4, 5]])
+    attention_mask = torch.ones_like(input_ids)
+    with torch.inference_mode():
+        expected = tiny_model.generate(
+            input_ids, attention_mask=attention_mask, max_new_tokens=12,
+            do_sample=False, num_beams=1, pad_token_id=63
+        )
+        sequences, _ = fast_decode(tiny_model, input_ids, attention_mask, 12, temperature=0)
+    assert sequences.tolist() == expected.tolist()
+
+
+def test_seeded_sampling_matches_generate(tiny_model):
+    input_ids = torch.tensor([[1, 2, 3, 4, 5]])
+    attention_mask = torch.ones_like(input_ids)
+    tiny_model.generation_config.top_k = 8
+    try:
+        with torch.inference_mode():
+            for seed in range(20):
+                torch.manual_seed(seed)
+                expected = tiny_model.generate(
+                    input_ids, attention_mask=attention_mask, max_new_tokens=12,
+                    do_sample=True, temperature=0.7, num_beams=1, pad_token_id=63
+                )
+                torch.manual_seed(seed)
+                sequences, _ = fast_decode(tiny_model, input_ids, attention_mask, 12, temperature=0.7)
+                assert sequences.tolist() == expected.tolist(), f"seed {seed}"
+    finally:
+        tiny_model.generation_config.top_k = 50
+
+
+def test_greedy_continues_from_cached_prefix(tiny_model):
+    input_ids = torch.tensor([[7, 8, 9, 10]])
+    with torch.inference_mode():
+        full, _ = fast_decode(tiny_model, input_ids, None, 8, temperature=0)
+        # Prefill the first three tokens, then let fast_decode feed only the rest
+        past_key_values = tiny_model(input_ids[:, :3], use_cache=True).past_key_values
+        resumed, _ = fast_decode(tiny_model, input_ids, None, 8, temperature=0, past_key_values=past_key_values)
+    assert resumed.tolist() == full.tolist()
+
+
+def test_supported_only_for_plain_configs(tiny_model):
+    kwargs = {"input_ids": None, "max_new_tokens": 4, "do_sample": True, "temperature": 0.7, "num_beams": 1}
+    assert fast_decode_supported(tiny_model, kwargs)
+    assert not fast_decode_supported(tiny_model, {**kwargs, "num_beams": 2})
+    assert not fast_decode_supported(tiny_model, {**kwargs, "stopping_criteria": []})
+
+    tiny_model.generation_config.repetition_penalty = 1.2
+    try:
+        assert not fast_decode_supported(tiny_model, kwargs)
+    finally:
+        tiny_model.generation_config.repetition_penalty = 1.0
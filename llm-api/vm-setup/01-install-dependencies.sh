@@ -19,6 +19,10 @@ sudo apt-get upgrade -y
 echo ">>> Installing Python and pip..."
 sudo apt-get install -y python3 python3-pip python3-venv git
 
+# jemalloc replaces glibc malloc for the API process (see LD_PRELOAD in llm-api.service)
+echo ">>> Installing jemalloc..."
+sudo apt-get install -y libjemalloc2
+
 # Create app directory
 echo ">>> Creating app directory..."
 sudo mkdir -p /opt/llm-api
@@ -42,7 +46,7 @@ echo "========================================="
 echo "Base setup complete!"
 echo ""
 echo "Next steps:"
-echo "1. Copy app.py to /opt/llm-api/app/"
+echo "1. Copy vm-setup/app.py and llm-api/decoding.py to /opt/llm-api/app/"
 echo "2. Set HF_TOKEN: echo 'HF_TOKEN=your_token' | sudo tee /opt/llm-api/.env"
 echo "3. Run: sudo cp /opt/llm-api/llm-api.service /etc/systemd/system/"
 echo "4. Run: sudo systemctl daemon-reload"
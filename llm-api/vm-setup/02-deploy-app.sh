@@ -20,6 +20,7 @@ echo "Deploying to VM at $VM_IP..."
 # Copy files to VM
 echo ">>> Copying application files..."
 scp app.py ${USER}@${VM_IP}:/opt/llm-api/app/
+scp ../decoding.py ${USER}@${VM_IP}:/opt/llm-api/app/
 scp llm-api.service ${USER}@${VM_IP}:/opt/llm-api/
 
 # Set up systemd service
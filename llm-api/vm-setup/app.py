@@ -4,34 +4,73 @@ This version is designed to run directly on a VM without Docker.
 For Docker deployment, use the parent directory's app.py
 """
 import os
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch
+import json
+import threading
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv('/opt/llm-api/.env')
 
+# Pin CPU threads before torch loads to avoid OpenMP oversubscription on small VMs.
+# TORCH_NUM_THREADS, then OMP_NUM_THREADS; otherwise torch's physical-core default is kept.
+NUM_THREADS = os.environ.get("TORCH_NUM_THREADS") or os.environ.get("OMP_NUM_THREADS")
+if NUM_THREADS:
+    NUM_THREADS = int(NUM_THREADS)
+    os.environ.setdefault("OMP_NUM_THREADS", str(NUM_THREADS))
+    os.environ.setdefault("MKL_NUM_THREADS", str(NUM_THREADS))
+os.environ.setdefault("MKL_DYNAMIC", "FALSE")
+
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask_cors import CORS
+from transformers import AutoModelForCausalLM, AutoTokenizer
+import torch
+
+# decoding.py lives in llm-api/ and is copied next to this file by 02-deploy-app.sh
+from decoding import fast_decode, fast_decode_supported, inference_context, sampling_kwargs, stream_events
+
+NUM_THREADS = NUM_THREADS or torch.get_num_threads()
+torch.set_num_threads(NUM_THREADS)
+torch.set_num_interop_threads(1)
+
 app = Flask(__name__)
 CORS(app, origins=[
     "https://ethicalaiditor.netlify.app",
     "http://localhost:5173",
     "http://localhost:3000"
-])
+], max_age=86400)  # Let browsers cache the preflight
 
 # Model configuration
 MODEL_NAME = "PleIAs/Pleias-350m-Preview"
 HF_TOKEN = os.environ.get("HF_TOKEN")
+# Prompts longer than this (in characters) are rejected before tokenization
+MAX_PROMPT_CHARS = 16384
+# Weight dtype - bfloat16 halves memory traffic vs float32 on CPU (set "float32" on older CPUs)
+DTYPE = os.environ.get("TORCH_DTYPE", "bfloat16").lower()
+TORCH_DTYPES = {
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+    "float32": torch.float32,
+}
+# Set QUANTIZE=int8 to dynamically quantize Linear layers (forces float32 load)
+QUANTIZE = os.environ.get("QUANTIZE", "").lower()
+# Set USE_IPEX=1 to optimize with intel-extension-for-pytorch (x86 only, ignored with QUANTIZE=int8)
+USE_IPEX = os.environ.get("USE_IPEX", "0") == "1" and QUANTIZE != "int8"
+# Set FAST_DECODE=false to always decode through transformers' generate()
+FAST_DECODE = os.environ.get("FAST_DECODE", "true").lower() == "true"
+# Max generations running on the model at once (each uses NUM_THREADS OpenMP threads);
+# the other gunicorn threads only parse, tokenize and answer health checks
+GENERATE_CONCURRENCY = int(os.environ.get("GENERATE_CONCURRENCY", 1))
 
 # Global model/tokenizer - loaded once at startup
 model = None
 tokenizer = None
+ipex_applied = False  # True once ipex.optimize has actually run
+_generate_slots = threading.Semaphore(GENERATE_CONCURRENCY)
 
 def load_model():
     """Load model at startup - only happens once since VM runs 24/7"""
-    global model, tokenizer
-    print(f"Loading model {MODEL_NAME}...")
+    global model, tokenizer, ipex_applied
+    print(f"Loading model {MODEL_NAME} ({DTYPE})...")
     
     tokenizer = AutoTokenizer.from_pretrained(
         MODEL_NAME,
@@ -43,20 +82,51 @@ def load_model():
         MODEL_NAME,
         token=HF_TOKEN,
         trust_remote_code=True,
-        torch_dtype=torch.float32,  # Use float32 for CPU
-        device_map="cpu"
+        # quantize_dynamic expects float32 Linear weights
+        torch_dtype=torch.float32 if QUANTIZE == "int8" else TORCH_DTYPES.get(DTYPE, torch.bfloat16),
+        low_cpu_mem_usage=True
     )
+    model.eval()  # Inference only - disable dropout
+    
+    if QUANTIZE == "int8":
+        print("Quantizing Linear layers to int8...")
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    
+    if USE_IPEX:
+        try:
+            import intel_extension_for_pytorch as ipex  # Optional x86-only dependency
+        except ImportError:
+            # Don't take the service down (systemd restart loop) over an optional optimization
+            print("WARNING: USE_IPEX=1 but intel_extension_for_pytorch is not installed - continuing without it")
+        else:
+            print("Optimizing model with IPEX (bfloat16)...")
+            model = ipex.optimize(model, dtype=torch.bfloat16, inplace=True)
+            ipex_applied = True
     
     print("Model loaded successfully!")
 
+def run_generate(generate_kwargs):
+    """fast_decode when it matches generate() for this model, else generate(). Returns the sequences."""
+    with _generate_slots:
+        if FAST_DECODE and fast_decode_supported(model, generate_kwargs):
+            sequences, _ = fast_decode(
+                model,
+                generate_kwargs["input_ids"],
+                generate_kwargs.get("attention_mask"),
+                generate_kwargs["max_new_tokens"],
+                generate_kwargs.get("temperature", 0) if generate_kwargs.get("do_sample") else 0
+            )
+            return sequences
+        return model.generate(**generate_kwargs)
+
+# Both possible /health bodies, serialized once instead of on every probe
+_HEALTH_LOADED = json.dumps({"status": "healthy", "model_loaded": True, "deployment": "compute-engine-vm"}).encode()
+_HEALTH_NOT_LOADED = json.dumps({"status": "healthy", "model_loaded": False, "deployment": "compute-engine-vm"}).encode()
+
 @app.route("/health", methods=["GET"])
 def health():
     """Health check endpoint"""
-    return jsonify({
-        "status": "healthy",
-        "model_loaded": model is not None,
-        "deployment": "compute-engine-vm"
-    })
+    return Response(_HEALTH_LOADED if model is not None else _HEALTH_NOT_LOADED, mimetype="application/json")
 
 @app.route("/chat", methods=["POST"])
 def chat():
@@ -71,6 +141,10 @@ def chat():
     
     if not prompt:
         return jsonify({"error": "No prompt provided"}), 400
+    if max_tokens > 500:
+        return jsonify({"error": "max_tokens cannot exceed 500 tokens"}), 400
+    if len(prompt) > MAX_PROMPT_CHARS:
+        return jsonify({"error": f"Prompt cannot exceed {MAX_PROMPT_CHARS} characters"}), 413
     
     try:
         # Truncate long inputs to avoid exceeding model limits
@@ -84,19 +158,24 @@ def chat():
         input_ids = inputs["input_ids"]
         attention_mask = inputs.get("attention_mask")
         
-        with torch.no_grad():
-            outputs = model.generate(
-                input_ids=input_ids,
-                attention_mask=attention_mask,
-                max_new_tokens=max_tokens,
-                temperature=temperature,
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id
-            )
+        generate_kwargs = dict(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=max_tokens,
+            use_cache=True,
+            pad_token_id=tokenizer.eos_token_id,
+            **sampling_kwargs(temperature)
+        )
+        if data.get("stream"):
+            events = stream_events(model, tokenizer, generate_kwargs, _generate_slots, ipex_applied)
+            return Response(stream_with_context(events), mimetype="text/event-stream")
+        
+        with inference_context(ipex_applied):
+            outputs = run_generate(generate_kwargs)
         
-        generated_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        # Remove the input prompt from the response
-        response_text = generated_text[len(prompt):].strip()
+        # Decode only the new tokens - slicing the decoded string by len(prompt) is unreliable
+        input_len = input_ids.shape[1]
+        response_text = tokenizer.decode(outputs[0, input_len:], skip_special_tokens=True).strip()
         
         return jsonify({
             "response": response_text,
@@ -119,4 +198,5 @@ print("="*50)
 load_model()
 
 if __name__ == "__main__":
+    # Local testing only - systemd runs this under gunicorn (see llm-api.service)
     app.run(host="0.0.0.0", port=8080)